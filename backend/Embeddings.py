@@ -0,0 +1,133 @@
+import functools
+import os
+import shutil
+import uuid
+from typing import List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_huggingface.embeddings import HuggingFaceEmbeddings
+
+model_id = "sentence-transformers/all-MiniLM-L6-v2"
+
+# Longest input (in tokens) all-MiniLM-L6-v2 was trained on
+MAX_SEQ_LENGTH = 256
+
+# Where the exported and quantized ONNX model is kept between runs - use /tmp for Render's ephemeral storage
+ONNX_CACHE_DIR = os.getenv("ONNX_CACHE_DIR", "/tmp/onnx_models/all-MiniLM-L6-v2")
+QUANTIZED_FILE_NAME = "model_quantized.onnx"
+
+# The all-MiniLM-L6-v2 tokenizer, loaded once and shared
+@functools.lru_cache(maxsize=1)
+def get_tokenizer():
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(model_id)
+
+# Cut text after its first max_tokens tokens, keeping the original characters (the tokenizer is uncased,
+# so decoding token ids would lose case and spacing). Tokens are rarely longer than 8 characters, so only
+# that much of the text is tokenized.
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    head = text[:max_tokens * 8]
+    offsets = get_tokenizer()(head, add_special_tokens=False, return_offsets_mapping=True)["offset_mapping"]
+    if len(offsets) <= max_tokens:
+        return head
+    return head[:offsets[max_tokens - 1][1]]
+
+# all-MiniLM-L6-v2 exported to ONNX and dynamically quantized to INT8 for CPU inference.
+# Produces the same mean-pooled, L2-normalized sentence embeddings as the sentence-transformers model.
+class QuantizedMiniLMEmbeddings(Embeddings):
+    def __init__(self, cache_dir: str = ONNX_CACHE_DIR, batch_size: int = 64):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+
+        self.batch_size = batch_size
+        if not os.path.exists(os.path.join(cache_dir, QUANTIZED_FILE_NAME)):
+            self._export_and_quantize(cache_dir)
+        self.tokenizer = AutoTokenizer.from_pretrained(cache_dir)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(cache_dir, file_name=QUANTIZED_FILE_NAME)
+
+    # One-off conversion: export the PyTorch model to ONNX, then quantize its weights to INT8.
+    # The model and tokenizer are written to a temporary directory that is renamed into place once complete,
+    # so an interrupted export or another worker exporting at the same time never leaves a partial cache_dir.
+    @staticmethod
+    def _export_and_quantize(cache_dir: str):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        from transformers import AutoTokenizer
+
+        print(f"Exporting {model_id} to a quantized ONNX model in {cache_dir}")
+        tmp_dir = f"{cache_dir}.{uuid.uuid4().hex}.tmp"
+        try:
+            onnx_model = ORTModelForFeatureExtraction.from_pretrained(model_id, export=True)
+            quantizer = ORTQuantizer.from_pretrained(onnx_model)
+            qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+            quantizer.quantize(save_dir=tmp_dir, quantization_config=qconfig)
+            AutoTokenizer.from_pretrained(model_id).save_pretrained(tmp_dir)
+            try:
+                os.replace(tmp_dir, cache_dir)
+            except OSError:
+                # Another worker finished exporting first
+                pass
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        embeddings = []
+        for i in range(0, len(texts), self.batch_size):
+            batch = [text.replace("\n", " ") for text in texts[i:i + self.batch_size]]
+            inputs = self.tokenizer(
+                batch, padding=True, truncation=True, max_length=MAX_SEQ_LENGTH, return_tensors="np"
+            )
+            token_embeddings = self.model(**inputs).last_hidden_state
+            # Mean-pool over the real (non-padding) tokens, then L2-normalize
+            mask = inputs["attention_mask"][..., None].astype(token_embeddings.dtype)
+            pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            embeddings.extend(pooled.tolist())
+        return embeddings
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text])[0]
+
+def _cpu_supports_bf16():
+    import torch
+    is_supported = getattr(torch.cpu, "_is_avx512_bf16_supported", None)
+    return bool(is_supported and is_supported())
+
+# PyTorch sentence-transformers model with its transformer compiled by torch.compile, and cast to
+# bfloat16 on CPUs with native AVX-512 BF16 support (FP32 elsewhere). Compilation happens on the first
+# forward pass, so the constructor runs a warm-up embedding to keep that cost off real requests.
+# If compiling fails (e.g. no C++ toolchain for the inductor backend), the model runs eagerly instead.
+class CompiledHuggingFaceEmbeddings(HuggingFaceEmbeddings):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        import torch
+
+        transformer = self._client[0]
+        model = transformer.auto_model
+        if _cpu_supports_bf16():
+            model = model.to(torch.bfloat16)
+        try:
+            # Default mode: "reduce-overhead" relies on CUDA graphs and does nothing extra on CPU.
+            # Sequence length varies per batch, so compile for dynamic shapes to avoid recompiling.
+            transformer.auto_model = torch.compile(model, dynamic=True)
+            self.embed_documents(["warmup"])
+        except Exception as e:
+            print(f"Warning: torch.compile failed ({e}), using the eager PyTorch model.")
+            transformer.auto_model = model
+
+# Load the quantized ONNX model, falling back to the PyTorch sentence-transformers model
+# when optimum/onnxruntime are not installed.
+def load_embeddings_model(batch_size: int = 64):
+    try:
+        return QuantizedMiniLMEmbeddings(batch_size=batch_size)
+    except ImportError as e:
+        print(f"Warning: Quantized ONNX embeddings unavailable ({e}), using the PyTorch model.")
+        return CompiledHuggingFaceEmbeddings(
+            model_name=model_id,
+            model_kwargs={'device': 'cpu'},
+            encode_kwargs={'batch_size': batch_size, 'normalize_embeddings': True}
+        )
@@ -0,0 +1,46 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Optional
+
+import requests
+from huggingface_hub import configure_http_backend, constants
+from huggingface_hub.utils._http import OfflineAdapter, UniqueRequestIdAdapter
+from langchain_huggingface import HuggingFaceEndpoint
+
+# Keep-alive connections kept per host, shared by all HuggingFace Inference Endpoint calls
+POOL_SIZE = 32
+
+# huggingface_hub keeps one Session per thread built from this factory, so each thread reuses
+# its open connections instead of paying a TCP + TLS handshake on every LLM call.
+# The factory serves every hub request in the process (model and tokenizer downloads too), so it keeps
+# the default one's behaviour: refuse all requests when HF_HUB_OFFLINE is set, else tag each with a request id.
+def _pooled_session() -> requests.Session:
+    session = requests.Session()
+    if constants.HF_HUB_OFFLINE:
+        adapter = OfflineAdapter()
+    else:
+        adapter = UniqueRequestIdAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+configure_http_backend(backend_factory=_pooled_session)
+
+# Threads that wait on LLM generations, one per pooled connection. Kept apart from the event loop's
+# default executor so minutes-long generations never hold up the short blocking work (file writes,
+# text extraction, query embedding) that the API runs there.
+_llm_executor = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix="hf-endpoint")
+
+# HuggingFaceEndpoint whose async calls go through the pooled sync client in an LLM worker thread.
+# The stock async client opens a new aiohttp session, and so a new connection, for every request.
+class PooledHuggingFaceEndpoint(HuggingFaceEndpoint):
+    async def _acall(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> str:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_llm_executor, functools.partial(self._call, prompt, stop, None, **kwargs))
@@ -1,4 +1,4 @@
-from langchain_huggingface import HuggingFaceEndpoint
+from .Endpoint import PooledHuggingFaceEndpoint
 import os
 from dotenv import load_dotenv
 
@@ -12,7 +12,7 @@ if not HUGGINGFACEHUB_API_TOKEN:
 
 repo_id = "meta-llama/Meta-Llama-3.1-8B-Instruct"
 
-llama3 = HuggingFaceEndpoint(
+llama3 = PooledHuggingFaceEndpoint(
     repo_id=repo_id,
     huggingfacehub_api_token=HUGGINGFACEHUB_API_TOKEN,
     temperature=0.01,
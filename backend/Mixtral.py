@@ -1,4 +1,4 @@
-from langchain_huggingface import HuggingFaceEndpoint
+from .Endpoint import PooledHuggingFaceEndpoint
 import os
 from dotenv import load_dotenv
 
@@ -12,7 +12,7 @@ if not HUGGINGFACEHUB_API_TOKEN:
 
 repo_id = "mistralai/Mixtral-8x7B-Instruct-v0.1"
 
-mixtral_llm = HuggingFaceEndpoint(
+mixtral_llm = PooledHuggingFaceEndpoint(
     repo_id=repo_id,
     max_length=128,
     temperature=0.01,
@@ -1,97 +1,452 @@
+import asyncio
+import hashlib
+import io
+import itertools
+import json
+import math
+import multiprocessing
 import os
+import pickle
+import shutil
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
 # Disable tokenizers parallelism to avoid fork warnings.
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
-from PyPDF2 import PdfReader
-from langchain_huggingface.embeddings import HuggingFaceEmbeddings
+import faiss
+import numpy as np
+import pypdfium2 as pdfium
 from langchain_core.documents import Document
-from langchain_text_splitters import CharacterTextSplitter
+from langchain_text_splitters import RecursiveCharacterTextSplitter
 import chromadb
 from langchain_chroma import Chroma
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+from .Embeddings import MAX_SEQ_LENGTH, get_tokenizer, load_embeddings_model, model_id as embeddings_model_id
+
+# On-disk cache for extracted text and vectorstores - use /tmp for Render's ephemeral storage
+CACHE_DIR = os.getenv("PIPELINE_CACHE_DIR", "/tmp/cache")
+# Bump whenever extraction, chunking or embedding changes so stale cache entries are not reused
+PIPELINE_VERSION = "3"
+# Number of most recently used entries kept per cache; older ones are evicted
+CACHE_MAX_ENTRIES = int(os.getenv("PIPELINE_CACHE_MAX_ENTRIES", "32"))
+
+# Points at the most recently processed vectorstore on disk. Kept in a file rather than app.state
+# so every worker process answers questions against the same index.
+ACTIVE_VECTORSTORE_FILE = os.getenv("ACTIVE_VECTORSTORE_FILE", "/tmp/faiss_idx/active.json")
+
+def _file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def _cache_path(kind, key):
+    return os.path.join(CACHE_DIR, kind, f"{key}-v{PIPELINE_VERSION}")
+
+# Mark a cache entry as recently used so LRU eviction keeps it
+def _touch(path):
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+# Directory of the vectorstore questions are currently answered from, if any
+def _active_vectorstore_path():
+    try:
+        with open(ACTIVE_VECTORSTORE_FILE) as f:
+            return json.load(f)["path"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+# Drop the least recently used entries of a cache once it holds more than CACHE_MAX_ENTRIES,
+# never removing the paths in keep. Other requests may be evicting at the same time, so entries
+# that disappear underneath are skipped.
+def _evict_lru(kind, keep=()):
+    directory = os.path.join(CACHE_DIR, kind)
+    entries = []
+    for name in os.listdir(directory):
+        if name.endswith(".tmp"):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            entries.append((os.path.getmtime(path), path))
+        except FileNotFoundError:
+            continue
+    entries.sort(reverse=True)
+    for _, path in entries[CACHE_MAX_ENTRIES:]:
+        if path in keep:
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+def _load_cached_text(file_hash):
+    path = _cache_path("text", file_hash) + ".pkl"
+    try:
+        with open(path, "rb") as f:
+            page_texts = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None
+    _touch(path)
+    return page_texts
+
+def _save_cached_text(file_hash, page_texts):
+    path = _cache_path("text", file_hash) + ".pkl"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so concurrent readers never see a partial pickle
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(page_texts, f)
+        os.replace(tmp_path, path)
+        _evict_lru("text")
+    except OSError as e:
+        print(f"Warning: Could not cache extracted text: {e}")
+
+# Percent of darkest/brightest pixels clipped when stretching page contrast for OCR
+AUTOCONTRAST_CUTOFF = 2
+
+# Preprocess a rendered page for OCR: convert to grayscale and auto-contrast to improve accuracy.
+# The contrast stretch runs on the whole pixel buffer with NumPy: a 256-bin histogram gives the
+# cutoff levels, and a 256-entry lookup table remaps every pixel in one vectorized pass.
+def preprocess_page_image(image):
+    from PIL import Image
+    pixels = np.asarray(image.convert("L"))
+    cumulative = np.cumsum(np.bincount(pixels.ravel(), minlength=256))
+    cutoff = cumulative[-1] * AUTOCONTRAST_CUTOFF / 100
+    lo = int(np.searchsorted(cumulative, cutoff, side="right"))
+    hi = int(np.searchsorted(cumulative, cumulative[-1] - cutoff))
+    if hi <= lo:
+        return Image.fromarray(pixels)
+    levels = np.arange(256, dtype=np.float32)
+    lut = np.clip((levels - lo) * 255 / (hi - lo), 0, 255).astype(np.uint8)
+    return Image.fromarray(lut[pixels])
+
+# Seconds Tesseract may spend on one page. Concurrent pages share the CPU cores, so a dense page
+# can take far longer than it would alone.
+OCR_TIMEOUT = float(os.getenv("OCR_TIMEOUT", "300"))
+
+# OCR a single page. Rendering runs in a worker thread and Tesseract is awaited as a
+# subprocess, so many pages can be in flight at once; the semaphore bounds how many.
+# Returns "" when the page has no text, and None when OCR itself failed so the result isn't cached.
+async def _ocr_page(pdf, page_num, sem):
+    async with sem:
+        try:
+            from pdf2image import convert_from_path
+            import aiopytesseract
+
+            # Convert the current page to an image with high DPI (e.g., 300)
+            images = await asyncio.to_thread(
+                convert_from_path, pdf, first_page=page_num, last_page=page_num, dpi=300
+            )
+            if not images:
+                print(f"Warning: Could not convert page {page_num} to image for OCR in {pdf}.")
+                return None
+            buffer = io.BytesIO()
+            preprocess_page_image(images[0]).save(buffer, format="PNG")
+            ocr_text = await aiopytesseract.image_to_string(buffer.getvalue(), timeout=OCR_TIMEOUT)
+            if ocr_text and ocr_text.strip():
+                print(f"OCR succeeded on page {page_num} in {pdf}.")
+                return ocr_text
+            print(f"Warning: OCR returned no text on page {page_num} in {pdf}.")
+            return ""
+        except Exception as e:
+            print(f"Warning: OCR failed for page {page_num} in {pdf}: {e}")
+            return None
+
+# Run OCR for all (pdf, page_num) pairs concurrently, returning texts in the same order.
+async def _ocr_pages(pages):
+    sem = asyncio.Semaphore(int(os.getenv("OCR_CONCURRENCY", os.cpu_count() or 1)))
+    return await asyncio.gather(*[_ocr_page(pdf, page_num, sem) for pdf, page_num in pages])
+
+# Worker processes used for page text extraction
+PDF_EXTRACTION_WORKERS = int(os.getenv("PDF_EXTRACTION_WORKERS", os.cpu_count() or 1))
+# Below this many pages, extracting serially is faster than starting worker processes
+PARALLEL_EXTRACTION_MIN_PAGES = 16
+
+# PDFium is not thread-safe, so in-process use is serialized; worker processes each have their own copy
+_pdfium_lock = threading.Lock()
+
+# Workers are forked from a single-threaded forkserver rather than from the server process, where another
+# request's thread may be inside PDFium mid-call. The forkserver preloads this module once, so each new
+# worker starts with PDFium and the rest of the pipeline already imported.
+_extraction_context = multiprocessing.get_context("forkserver")
+_extraction_context.set_forkserver_preload([__name__])
+
+# Loaded from bytes rather than by path so a forked worker never shares a file offset with the parent
+def _open_pdf(pdf):
+    with open(pdf, "rb") as f:
+        return pdfium.PdfDocument(f.read())
+
+# Extract the embedded text of one page of an open document
+def _extract_page(document, page_num):
+    page = document[page_num - 1]
+    try:
+        textpage = page.get_textpage()
+        try:
+            # PDFium separates lines with CRLF
+            page_text = textpage.get_text_range().replace("\r\n", "\n")
+        finally:
+            textpage.close()
+    finally:
+        page.close()
+    return page_text if page_text and page_text.strip() else ""
+
+# Documents a pool worker has opened, kept open across the pages it is handed. Keyed by content hash
+# so a re-uploaded file with the same name is reopened. Lives only as long as the worker, which exits
+# with its pool at the end of get_pdf_text.
+_worker_pdfs = {}
+
+def _init_extraction_worker():
+    _worker_pdfs.clear()
+
+# Pool task: extract one page's text in a worker process. Module-level so it can be pickled.
+def _extract_page_in_worker(task):
+    pdf, file_hash, page_num = task
+    document = _worker_pdfs.get((pdf, file_hash))
+    if document is None:
+        document = _worker_pdfs[(pdf, file_hash)] = _open_pdf(pdf)
+    return _extract_page(document, page_num)
 
 # Updated function to extract text from PDFs with OCR fallback for image-based text.
 # Now, each page is converted into its own Document with metadata containing the source and page number.
+# Pages are extracted across a process pool, then pages without embedded text are OCR'd concurrently in a single pass.
+# Extracted page texts are cached by file content hash, so re-processing a PDF skips extraction and OCR.
 def get_pdf_text(docs):
     documents_text = []
+    tasks = []
+    to_cache = []
     for pdf in docs:
-        pdf_reader = PdfReader(pdf)
-        # Process each page individually
-        for page_num, page in enumerate(pdf_reader.pages, start=1):
-            page_text = page.extract_text()
-            final_text = ""
-            if page_text and page_text.strip():
-                final_text = page_text
-            else:
-                print(f"Warning: No text extracted from page {page_num} in {pdf}, attempting OCR.")
-                try:
-                    from pdf2image import convert_from_path
-                    import pytesseract
-                    from PIL import ImageOps
-                    # Convert the current page to an image with high DPI (e.g., 300)
-                    images = convert_from_path(pdf, first_page=page_num, last_page=page_num, dpi=300)
-                    if images:
-                        # Preprocess the image: convert to grayscale and auto-contrast to improve OCR accuracy
-                        image = images[0].convert("L")
-                        enhanced_image = ImageOps.autocontrast(image)
-                        ocr_text = pytesseract.image_to_string(enhanced_image)
-                        if ocr_text and ocr_text.strip():
-                            print(f"OCR succeeded on page {page_num} in {pdf}.")
-                            final_text = ocr_text
-                        else:
-                            print(f"Warning: OCR returned no text on page {page_num} in {pdf}.")
-                    else:
-                        print(f"Warning: Could not convert page {page_num} to image for OCR in {pdf}.")
-                except Exception as e:
-                    print(f"Warning: OCR failed for page {page_num} in {pdf}: {e}")
-            if not final_text.strip():
-                print(f"Warning: No text extracted from page {page_num} in {pdf}")
-            # Create a Document for each page with metadata for source and page number
-            document = Document(
-                page_content=final_text,
+        file_hash = _file_hash(pdf)
+        cached_pages = _load_cached_text(file_hash)
+        if cached_pages is not None:
+            print(f"Using cached text for {pdf}")
+            for page_num, page_text in enumerate(cached_pages, start=1):
+                documents_text.append(Document(
+                    page_content=page_text,
+                    metadata={"source": pdf, "page": page_num}
+                ))
+            continue
+
+        first_index = len(documents_text)
+        with _pdfium_lock:
+            document = _open_pdf(pdf)
+            page_count = len(document)
+            document.close()
+        # Create a Document for each page with metadata for source and page number; text is filled in below
+        for page_num in range(1, page_count + 1):
+            tasks.append((len(documents_text), pdf, file_hash, page_num))
+            documents_text.append(Document(
+                page_content="",
                 metadata={"source": pdf, "page": page_num}
-            )
-            documents_text.append(document)
+            ))
+        to_cache.append((file_hash, first_index, len(documents_text)))
+
+    page_args = [task[1:] for task in tasks]
+    if len(page_args) >= PARALLEL_EXTRACTION_MIN_PAGES and PDF_EXTRACTION_WORKERS > 1:
+        # map() yields results in task order, so page order is preserved
+        with ProcessPoolExecutor(
+            max_workers=PDF_EXTRACTION_WORKERS, mp_context=_extraction_context, initializer=_init_extraction_worker
+        ) as executor:
+            page_texts = list(executor.map(_extract_page_in_worker, page_args, chunksize=4))
+    else:
+        page_texts = []
+        with _pdfium_lock:
+            # Each document is open only while its pages are extracted, then closed to free PDFium's memory
+            for pdf, pages in itertools.groupby(page_args, key=lambda args: args[0]):
+                document = _open_pdf(pdf)
+                try:
+                    page_texts.extend(_extract_page(document, page_num) for _, _, page_num in pages)
+                finally:
+                    document.close()
+
+    ocr_pending = []
+    for (doc_index, pdf, _, page_num), page_text in zip(tasks, page_texts):
+        if page_text:
+            documents_text[doc_index].page_content = page_text
+        else:
+            print(f"Warning: No text extracted from page {page_num} in {pdf}, attempting OCR.")
+            ocr_pending.append((doc_index, pdf, page_num))
+
+    # PDFs with a page whose OCR failed are not cached, so the next request retries them
+    failed_pdfs = set()
+    if ocr_pending:
+        ocr_texts = asyncio.run(_ocr_pages([(pdf, page_num) for _, pdf, page_num in ocr_pending]))
+        for (doc_index, pdf, _), ocr_text in zip(ocr_pending, ocr_texts):
+            if ocr_text is None:
+                failed_pdfs.add(pdf)
+            else:
+                documents_text[doc_index].page_content = ocr_text
+
+    for file_hash, first_index, end_index in to_cache:
+        if documents_text[first_index].metadata["source"] in failed_pdfs:
+            print(f"Not caching text for {documents_text[first_index].metadata['source']}: OCR failed on some pages")
+            continue
+        _save_cached_text(file_hash, [document.page_content for document in documents_text[first_index:end_index]])
+
+    for document in documents_text:
+        if not document.page_content.strip():
+            print(f"Warning: No text extracted from page {document.metadata['page']} in {document.metadata['source']}")
     return documents_text
 
-# Converting text to chunks
+# Split plain text into pieces of at most max_tokens embedding-model tokens
+def split_by_tokens(text, max_tokens):
+    text_splitter = RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+        get_tokenizer(),
+        chunk_size=max_tokens,
+        chunk_overlap=0
+    )
+    return text_splitter.split_text(text)
+
+# Tokens per chunk: the model's max sequence length minus the [CLS] and [SEP] tokens it adds
+CHUNK_SIZE_TOKENS = MAX_SEQ_LENGTH - 2
+CHUNK_OVERLAP_TOKENS = 32
+
+# Converting text to chunks measured in embedding-model tokens, so no chunk is truncated when embedded
 def get_chunks(raw_text_documents):
-    text_splitter = CharacterTextSplitter(
-        separator="\n",
-        chunk_size=1000,
-        chunk_overlap=200,
-        length_function=len
+    text_splitter = RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+        get_tokenizer(),
+        chunk_size=CHUNK_SIZE_TOKENS,
+        chunk_overlap=CHUNK_OVERLAP_TOKENS
     )
     chunks = text_splitter.split_documents(raw_text_documents)
     print(f"Number of text chunks generated: {len(chunks)}")
     return chunks
 
-# Using all-MiniLM embeddings model and FAISS to get vectorstore
-def get_vectorstore(chunked_text):
-    if not chunked_text or len(chunked_text) == 0:
-        raise ValueError("No text chunks provided to generate embeddings.")
+# Number of chunks embedded per forward pass of the embeddings model
+EMBEDDING_BATCH_SIZE = 64
 
-    # Instantiate the embeddings model
-    embeddings_model = HuggingFaceEmbeddings(
-        model_name="sentence-transformers/all-MiniLM-L6-v2",
-        model_kwargs={'device': 'cpu'}
+# Embeddings model shared by all requests, so the weights are loaded only once per process
+_embeddings_model = None
+_embeddings_model_lock = threading.Lock()
+
+def get_embeddings_model():
+    global _embeddings_model
+    if _embeddings_model is None:
+        with _embeddings_model_lock:
+            if _embeddings_model is None:
+                _embeddings_model = load_embeddings_model(batch_size=EMBEDDING_BATCH_SIZE)
+    return _embeddings_model
+
+# Below this many chunks, scanning an 8-bit scalar-quantized index is fast enough and exact enough;
+# above it, an IVF-PQ fast-scan index keeps query time from growing with the corpus
+IVF_PQ_MIN_VECTORS = 100_000
+# Product-quantizer sub-vectors per embedding (4 bits each) for the IVF-PQ fast-scan index
+PQ_SUBQUANTIZERS = 32
+# Fraction of the inverted lists searched per query
+IVF_NPROBE_FRACTION = 1 / 8
+# The 4-bit PQ codes only shortlist candidates: k * REFINE_K_FACTOR of them are re-ranked with 8-bit codes
+REFINE_K_FACTOR = 16
+
+# Build the FAISS index over normalized embeddings, where inner product equals cosine similarity.
+# Most corpora get an 8-bit scalar-quantized index that stores one byte per dimension instead of four.
+# Very large corpora get an IVF-PQ fast-scan index (SIMD lookups over 4-bit PQ codes) with ~sqrt(N) lists,
+# whose shortlist is re-ranked against 8-bit codes, as 4-bit PQ alone loses too much recall.
+def build_faiss_index(embeddings):
+    xb = np.asarray(embeddings, dtype="float32")
+    n, d = xb.shape
+    if n < IVF_PQ_MIN_VECTORS or d % PQ_SUBQUANTIZERS != 0:
+        index = faiss.IndexScalarQuantizer(d, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+        index.train(xb)
+    else:
+        nlist = int(math.sqrt(n))
+        index = faiss.index_factory(
+            d, f"IVF{nlist},PQ{PQ_SUBQUANTIZERS}x4fs,Refine(SQ8)", faiss.METRIC_INNER_PRODUCT
+        )
+        index.train(xb)
+        faiss.extract_index_ivf(index).nprobe = max(1, int(nlist * IVF_NPROBE_FRACTION))
+        index.k_factor = REFINE_K_FACTOR
+    index.add(xb)
+    return index
+
+# Cache key for a vectorstore: the embeddings model plus every chunk's source, page and text
+def _chunks_hash(chunked_text):
+    sha = hashlib.sha256(embeddings_model_id.encode())
+    for chunk in chunked_text:
+        sha.update(f"\0{chunk.metadata.get('source')}\0{chunk.metadata.get('page')}\0".encode())
+        sha.update(chunk.page_content.encode())
+    return sha.hexdigest()
+
+# Load a saved vectorstore. Workers share it on disk, but each reads the index into its own memory:
+# FAISS can't memory-map the scalar-quantized or fast-scan indexes built here.
+def load_vectorstore(path):
+    index = faiss.read_index(os.path.join(path, "index.faiss"))
+    with open(os.path.join(path, "index.pkl"), "rb") as f:
+        # Only ever reads vectorstores this app saved itself
+        docstore, index_to_docstore_id = pickle.load(f)
+    _touch(path)
+    return FAISS(
+        embedding_function=get_embeddings_model(),
+        index=index,
+        docstore=docstore,
+        index_to_docstore_id=index_to_docstore_id,
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
     )
 
-    # Generate a sample embedding to verify that embeddings are being generated
+def _save_vectorstore(path, vectordb):
+    # Save into a temporary directory first so concurrent readers never see a partial index
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    vectordb.save_local(tmp_path)
     try:
-        sample_embedding = embeddings_model.embed_documents([chunked_text[0].page_content])
-        if sample_embedding and sample_embedding[0]:
-            print(f"Sample embedding length: {len(sample_embedding[0])}")
-        else:
-            print("Warning: Sample embedding is empty.")
-    except Exception as e:
-        print(f"Error generating sample embedding: {e}")
+        os.replace(tmp_path, path)
+    except OSError:
+        # Another request saved the same vectorstore first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    # Keep the index that questions are being answered from, however long ago it was used
+    _evict_lru("vectorstore", keep={_active_vectorstore_path()})
+
+# Using INT8-quantized all-MiniLM embeddings model and FAISS to build the vectorstore, saved on disk
+# keyed by the chunk contents so re-processing the same PDFs skips embedding. Returns the saved directory.
+def get_vectorstore_path(chunked_text):
+    if not chunked_text or len(chunked_text) == 0:
+        raise ValueError("No text chunks provided to generate embeddings.")
+
+    cache_path = _cache_path("vectorstore", _chunks_hash(chunked_text))
+    if os.path.isdir(cache_path):
+        print(f"Using cached vectorstore from {cache_path}")
+        _touch(cache_path)
+        return cache_path
+
+    embeddings_model = get_embeddings_model()
 
-    # Create the FAISS vectorstore from documents and embeddings
+    # Embed the chunks in fixed-size batches so each forward pass covers many chunks
+    texts = [chunk.page_content for chunk in chunked_text]
+    embeddings = []
+    for i in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+        embeddings.extend(embeddings_model.embed_documents(texts[i:i + EMBEDDING_BATCH_SIZE]))
+
+    # Verify that embeddings are being generated
+    if embeddings and embeddings[0]:
+        print(f"Embedding length: {len(embeddings[0])}")
+    else:
+        print("Warning: Sample embedding is empty.")
+
+    # Create the FAISS vectorstore from the precomputed embeddings
     try:
-        vectordb = FAISS.from_documents(documents=chunked_text, embedding=embeddings_model)
+        index = build_faiss_index(embeddings)
+        print(f"Built {type(index).__name__} over {index.ntotal} chunks")
+        doc_ids = [str(uuid.uuid4()) for _ in chunked_text]
+        vectordb = FAISS(
+            embedding_function=embeddings_model,
+            index=index,
+            docstore=InMemoryDocstore(dict(zip(doc_ids, chunked_text))),
+            index_to_docstore_id=dict(enumerate(doc_ids)),
+            distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
+        )
     except Exception as e:
         print(f"Error creating FAISS vectorstore: {e}")
         raise e
 
-    return vectordb
\ No newline at end of file
+    _save_vectorstore(cache_path, vectordb)
+    return cache_path
+
+def get_vectorstore(chunked_text):
+    return load_vectorstore(get_vectorstore_path(chunked_text))
@@ -1,17 +1,26 @@
+import asyncio
+import functools
+import json
 import os
+import uuid
 from fastapi import FastAPI, File, UploadFile, Form
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 from typing import List
+from contextlib import asynccontextmanager
 from .Llama3 import llama3
 from .Mixtral import mixtral_llm
 from .Phi import phi
-from .Vectorstore import get_pdf_text, get_chunks, get_vectorstore
+from .Embeddings import truncate_to_tokens
+from .Vectorstore import (
+    ACTIVE_VECTORSTORE_FILE, get_pdf_text, get_chunks, split_by_tokens, get_vectorstore_path, load_vectorstore,
+    get_embeddings_model
+)
 from langchain.prompts import PromptTemplate
 from langchain.memory import ConversationBufferMemory
 from langchain.chains import ConversationalRetrievalChain
 from fastapi.middleware.cors import CORSMiddleware
-import shutil
+import aiofiles
 import logging
 
 # Configure logging
@@ -19,7 +28,22 @@ logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+def _warm_up_embeddings():
+    try:
+        get_embeddings_model()
+        logger.info("Embeddings model loaded")
+    except Exception as e:
+        logger.error(f"Error loading embeddings model: {str(e)}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load the embeddings model in the background so startup (and the health check) isn't held up,
+    # while the first /process_pdfs/ request finds it already warm
+    warm_up = asyncio.create_task(asyncio.to_thread(_warm_up_embeddings))
+    yield
+    await warm_up
+
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware to allow requests from any origin
 app.add_middleware(
@@ -36,6 +60,9 @@ if not os.path.exists(PDF_DIR):
     os.makedirs(PDF_DIR)
     logger.info(f"Created directory: {PDF_DIR}")
 
+# Size of each read/write when streaming uploads to disk
+UPLOAD_CHUNK_SIZE = 1 << 20
+
 # Keep track of uploaded files in memory since filesystem is ephemeral on Render
 uploaded_files_registry = {}
 
@@ -74,6 +101,31 @@ def get_conversation_chain(vectorstore, llm_choice: str):
     )
     return conversation_chain
 
+def publish_vectorstore(vectorstore_path: str, llm_choice: str) -> str:
+    os.makedirs(os.path.dirname(ACTIVE_VECTORSTORE_FILE), exist_ok=True)
+    # Unique per processing run, so workers rebuild their chain (and reset its memory) even for the same PDFs
+    run_id = uuid.uuid4().hex
+    tmp_path = f"{ACTIVE_VECTORSTORE_FILE}.{run_id}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"run_id": run_id, "path": vectorstore_path, "llm_choice": llm_choice}, f)
+    os.replace(tmp_path, ACTIVE_VECTORSTORE_FILE)
+    return run_id
+
+def get_active_conversation():
+    try:
+        with open(ACTIVE_VECTORSTORE_FILE) as f:
+            active = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    # Each worker loads the shared on-disk index once per processing run and caches its chain
+    if getattr(app.state, "run_id", None) != active["run_id"]:
+        logger.info(f"Loading vector store from {active['path']}")
+        vectorstore = load_vectorstore(active["path"])
+        app.state.conversation = get_conversation_chain(vectorstore, active["llm_choice"])
+        app.state.run_id = active["run_id"]
+    return app.state.conversation
+
 @app.post("/upload_pdfs/")
 async def upload_pdfs(files: List[UploadFile] = File(...)):
     logger.info(f"Received upload request for {len(files)} files")
@@ -89,12 +141,13 @@ async def upload_pdfs(files: List[UploadFile] = File(...)):
                 
             file_path = os.path.join(PDF_DIR, file.filename)
             
-            # Save the file
+            # Stream the file to disk in chunks so large PDFs are never held in memory
             try:
-                with open(file_path, "wb") as buffer:
-                    shutil.copyfileobj(file.file, buffer)
+                async with aiofiles.open(file_path, "wb") as buffer:
+                    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                        await buffer.write(chunk)
             finally:
-                file.file.close()  # Make sure to close the file after reading
+                await file.close()  # Make sure to close the file after reading
             
             # Check if file was actually saved
             if os.path.exists(file_path):
@@ -135,16 +188,19 @@ async def process_pdfs(llm_choice: str = Form(...), pdf_files: List[str] = Form(
     
     try:
         logger.info("Extracting text from PDFs...")
-        raw_text = get_pdf_text(all_selected_files)
+        # get_pdf_text drives its own event loop for OCR, so it must run off the server loop
+        raw_text = await asyncio.to_thread(get_pdf_text, all_selected_files)
         
         logger.info("Chunking text...")
-        text_chunks = get_chunks(raw_text)
+        text_chunks = await asyncio.to_thread(get_chunks, raw_text)
         
         logger.info("Creating vector store...")
-        vectorstore = get_vectorstore(text_chunks)
+        vectorstore_path = await asyncio.to_thread(get_vectorstore_path, text_chunks)
+        vectorstore = await asyncio.to_thread(load_vectorstore, vectorstore_path)
         
         logger.info("Creating conversation chain...")
         conversation_chain = get_conversation_chain(vectorstore, llm_choice)
+        app.state.run_id = publish_vectorstore(vectorstore_path, llm_choice)
         app.state.conversation = conversation_chain
         
         logger.info("PDFs processed successfully")
@@ -153,30 +209,35 @@ async def process_pdfs(llm_choice: str = Form(...), pdf_files: List[str] = Form(
         logger.error(f"Error processing PDFs: {str(e)}")
         return JSONResponse(status_code=500, content={"error": f"Error processing PDFs: {str(e)}"})
 
+# Retrieved chunks mostly come from the same few PDFs, so their file names are memoized
+_basename = functools.lru_cache(maxsize=128)(os.path.basename)
+
 @app.post("/ask_question/")
 async def ask_question(question_input: QuestionInput):
     logger.info(f"Question received: {question_input.question}")
     
-    if not hasattr(app.state, "conversation") or app.state.conversation is None:
+    try:
+        conversation = await asyncio.to_thread(get_active_conversation)
+    except Exception as e:
+        logger.error(f"Error loading vector store: {str(e)}")
+        conversation = None
+    if conversation is None:
         logger.error("No conversation chain found")
         return JSONResponse(status_code=400, content={"error": "No conversation chain found. Process PDFs first."})
 
     try:
         logger.info("Processing question...")
-        response = app.state.conversation({"question": question_input.question})
+        response = await conversation.ainvoke({"question": question_input.question})
         
         source_docs = response.get("source_documents", [])
-        sources = []
-        for doc in source_docs:
-            page = doc.metadata.get("page", "Unknown")
-            file_path = doc.metadata.get("source", "Unknown")
-            file_name = os.path.basename(file_path)
-            snippet = doc.page_content[:200]
-            sources.append({
-                "page": page,
-                "file": file_name,
-                "snippet": snippet
-            })
+        sources = [
+            {
+                "page": doc.metadata.get("page", "Unknown"),
+                "file": _basename(doc.metadata.get("source", "Unknown")),
+                "snippet": doc.page_content[:200]
+            }
+            for doc in source_docs
+        ]
 
         logger.info("Question answered successfully")
         return {
@@ -188,6 +249,50 @@ async def ask_question(question_input: QuestionInput):
         logger.error(f"Error processing question: {str(e)}")
         return JSONResponse(status_code=500, content={"error": f"Error processing question: {str(e)}"})
 
+# Approximate token budget for the report text in a summary prompt
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "3000"))
+# Longer reports are split into sections of SUMMARY_MAX_TOKENS that are summarized in parallel and then
+# combined (map-reduce). At most this many sections are summarized, which bounds the LLM calls per report.
+SUMMARY_MAX_SECTIONS = int(os.getenv("SUMMARY_MAX_SECTIONS", "16"))
+
+def _report_sections(file_path: str) -> List[str]:
+    raw_text = get_pdf_text([file_path])
+    combined_text = " ".join(doc.page_content for doc in raw_text)
+    combined_text = truncate_to_tokens(combined_text, SUMMARY_MAX_TOKENS * SUMMARY_MAX_SECTIONS)
+    # The splitter does not pack sections to the full budget, so cap the count explicitly
+    return split_by_tokens(combined_text, SUMMARY_MAX_TOKENS)[:SUMMARY_MAX_SECTIONS]
+
+# Combine partial summaries into one, first reducing them group by group while they don't fit in one prompt
+async def _reduce_summaries(partials: List[str], llm) -> str:
+    joined = "\n\n".join(partials)
+    groups = await asyncio.to_thread(split_by_tokens, joined, SUMMARY_MAX_TOKENS)
+    # Stop reducing once a round can't shrink the number of summaries (e.g. very long partials)
+    if len(groups) == 1 or len(groups) >= len(partials):
+        joined = await asyncio.to_thread(truncate_to_tokens, joined, SUMMARY_MAX_TOKENS)
+        prompt = f"Combine these partial summaries of a market research report into a concise paragraph:\n\n{joined}"
+        return await llm.ainvoke(prompt)
+    partials = await asyncio.gather(*[
+        llm.ainvoke(f"Combine these partial summaries of a market research report:\n\n{group}")
+        for group in groups
+    ])
+    return await _reduce_summaries(list(partials), llm)
+
+async def _summarize(file_path: str, llm):
+    logger.info(f"Extracting text from: {file_path}")
+    sections = await asyncio.to_thread(_report_sections, file_path)
+
+    logger.info(f"Generating summary for: {file_path} ({len(sections)} sections)")
+    if len(sections) <= 1:
+        combined_text = sections[0] if sections else ""
+        prompt = f"Summarize the following market research report in a concise paragraph:\n\n{combined_text}"
+        return await llm.ainvoke(prompt)
+
+    partials = await asyncio.gather(*[
+        llm.ainvoke(f"Summarize the following section of a market research report:\n\n{section}")
+        for section in sections
+    ])
+    return await _reduce_summaries(list(partials), llm)
+
 @app.post("/compare_reports/")
 async def compare_reports(llm_choice: str = Form(...), pdf_files: List[str] = Form(...)):
     logger.info(f"Comparing reports: {pdf_files} with LLM: {llm_choice}")
@@ -209,30 +314,17 @@ async def compare_reports(llm_choice: str = Form(...), pdf_files: List[str] = Fo
             )
 
     try:
-        summaries = {}
         llm = get_llm(llm_choice)
-        
-        for i, pdf in enumerate(pdf_files):
-            file_path = file_paths[i]
-            logger.info(f"Extracting text from: {file_path}")
-            raw_text = get_pdf_text([file_path])
-            
-            logger.info(f"Chunking text from: {file_path}")
-            text_chunks = get_chunks(raw_text)
-            
-            combined_text = " ".join([chunk.page_content for chunk in text_chunks])
-            prompt = f"Summarize the following market research report in a concise paragraph:\n\n{combined_text}"
-            
-            logger.info(f"Generating summary for: {file_path}")
-            summary = llm(prompt)
-            summaries[pdf] = summary
+        # Summarize both reports concurrently so their LLM round-trips overlap
+        summary_list = await asyncio.gather(*[_summarize(file_path, llm) for file_path in file_paths])
+        summaries = dict(zip(pdf_files, summary_list))
 
         logger.info("Comparing the two reports")
         compare_prompt = (
             f"Compare the following two market research reports and highlight their similarities, differences, "
-            f"and key insights:\n\nReport 1 Summary:\n{summaries[pdf_files[0]]}\n\nReport 2 Summary:\n{summaries[pdf_files[1]]}\n\nComparison:"
+            f"and key insights:\n\nReport 1 Summary:\n{summary_list[0]}\n\nReport 2 Summary:\n{summary_list[1]}\n\nComparison:"
         )
-        comparison = llm(compare_prompt)
+        comparison = await llm.ainvoke(compare_prompt)
 
         logger.info("Reports compared successfully")
         return {"comparison": comparison, "summaries": summaries}
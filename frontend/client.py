@@ -1,7 +1,16 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from urllib3.util import Retry
+import functools
+import html
 import os
+import random
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 # Read the backend URL from the environment variable, with a default for local testing
 BASE_API_URL = os.getenv("BACKEND_URL", "http://127.0.0.1:8000").strip()
@@ -9,95 +18,222 @@ BASE_API_URL = os.getenv("BACKEND_URL", "http://127.0.0.1:8000").strip()
 if BASE_API_URL.endswith(')'):
     BASE_API_URL = BASE_API_URL[:-1]
 
-# Add a health check function to verify backend is available
-def check_backend_health():
+# Custom CSS for UI enhancements using given HEX colors. It also styles Streamlit's own
+# title/header/subheader elements, which render as h1/h2/h3.
+_CSS = """
+<style>
+h1 {
+    color: #e14ed2;
+    text-align: center;
+}
+h2 {
+    color: #3edbda;
+}
+h3 {
+    color: #3edbda;
+}
+.stButton>button {
+    background-color: #e14ed2;
+    color: white;
+    border: none;
+}
+.stButton>button:hover {
+    background-color: #3edbda;
+}
+.error-message {
+    color: red;
+    background-color: #ffeeee;
+    padding: 10px;
+    border-radius: 5px;
+    margin: 10px 0;
+}
+</style>
+"""
+
+# Number of PDFs uploaded at once, each over its own pooled connection
+MAX_PARALLEL_UPLOADS = 6
+
+# Seconds to wait for a connection to the backend, and for each endpoint's response once connected.
+# Processing and comparing run OCR and the LLM over whole reports, so they get the longest read timeouts.
+CONNECT_TIMEOUT = 5
+READ_TIMEOUTS = {
+    "/health": 10,
+    "/upload_pdfs/": 120,
+    "/process_pdfs/": 600,
+    "/ask_question/": 120,
+    "/compare_reports/": 300,
+}
+
+def timeout_for(path):
+    return (CONNECT_TIMEOUT, READ_TIMEOUTS[path])
+
+# Transient backend failures are retried by the connection pool with exponential backoff and jitter:
+# roughly 0.5s, 1s, then 2s between attempts. Failing to connect is retried for any request, since
+# nothing reached the backend. Gateway errors (e.g. a 504 while the backend is still working) are only
+# retried for GETs, and read timeouts never are: resending a POST would repeat its OCR and LLM work and
+# add duplicate turns to the conversation memory.
+RETRY = Retry(
+    total=3,
+    read=0,
+    backoff_factor=0.5,
+    backoff_jitter=0.5,
+    status_forcelist=[502, 503, 504],
+    allowed_methods=frozenset(["GET"]),
+    raise_on_status=False,
+)
+
+# Shared HTTP session so every backend call reuses pooled keep-alive connections.
+# Cached as a resource so Streamlit reruns keep the same pool instead of opening new connections.
+@st.cache_resource
+def get_session(base_url):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=RETRY)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    # Streamed upload bodies can't be replayed by the pool, so uploads get no transport retries
+    # and are retried by upload_pdfs instead
+    session.mount(f"{base_url}/upload_pdfs/", HTTPAdapter(pool_maxsize=MAX_PARALLEL_UPLOADS))
+    # The health check runs on page load, so it fails fast rather than blocking the page through retries
+    session.mount(f"{base_url}/health", HTTPAdapter(pool_maxsize=1))
+    session.headers.update({"Connection": "keep-alive"})
+    return session
+
+SESSION = get_session(BASE_API_URL)
+
+# How long (in seconds) a backend health check result is reused across reruns
+HEALTH_CHECK_TTL = 30
+
+# Add a health check function to verify backend is available.
+# Cached per backend URL so widget interactions don't each pay a round trip; returns (ok, error message).
+@st.cache_data(ttl=HEALTH_CHECK_TTL, show_spinner=False)
+def check_backend_health(base_url):
     try:
-        response = requests.get(f"{BASE_API_URL}/health", timeout=10)
-        return response.status_code == 200
+        response = SESSION.get(f"{base_url}/health", timeout=timeout_for("/health"))
+        return response.status_code == 200, None
     except requests.exceptions.RequestException as e:
-        st.error(f"Backend connection error: {str(e)}")
-        return False
+        return False, str(e)
+
+# POST to a backend endpoint and return its JSON body.
+# Transient failures have already been retried by the session by the time an error is raised here.
+def _post(path, **kwargs):
+    response = SESSION.post(f"{BASE_API_URL}{path}", timeout=timeout_for(path), **kwargs)
+    response.raise_for_status()
+    return response.json()
 
-# Add a retry mechanism for important requests
-def request_with_retry(method, url, max_retries=3, **kwargs):
-    for attempt in range(max_retries):
+# Wrap a backend call so a failed request shows its error and returns None instead of raising
+def show_request_errors(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
         try:
-            response = method(url, **kwargs)
+            return func(*args, **kwargs)
+        except requests.exceptions.RequestException as e:
+            st.error(f"Request failed: {str(e)}")
+            return None
+    return wrapper
+
+# Apply the custom CSS
+st.markdown(_CSS, unsafe_allow_html=True)
+
+# Post PDFs as a multipart body streamed straight from the file handles instead of built in memory.
+# The encoder is rebuilt on every call because a consumed stream can't be sent again on retry.
+def post_pdf_files(url, files):
+    for file in files:
+        file.seek(0)
+    encoder = MultipartEncoder(fields=[("files", (file.name, file, "application/pdf")) for file in files])
+    return SESSION.post(
+        url, data=encoder, headers={"Content-Type": encoder.content_type}, timeout=timeout_for("/upload_pdfs/")
+    )
+
+# Attempts per PDF upload, and the base delay (in seconds) of the exponential backoff between them
+UPLOAD_RETRIES = 3
+UPLOAD_BACKOFF = 0.5
+
+# Upload one PDF, retrying only when the connection failed or timed out. Any other error (e.g. a 4xx
+# from the backend) won't go away on a second try, so it is reported straight away.
+def upload_pdf(url, file):
+    for attempt in range(UPLOAD_RETRIES):
+        try:
+            response = post_pdf_files(url, [file])
             response.raise_for_status()
             return response.json()
-        except requests.exceptions.RequestException as e:
-            if attempt == max_retries - 1:
-                st.error(f"Request failed after {max_retries} attempts: {str(e)}")
-                if "files" in kwargs and method == requests.post:
-                    st.error("File upload failed. Please try again with smaller files or fewer files.")
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt == UPLOAD_RETRIES - 1:
+                st.error(f"Uploading {file.name} failed after {UPLOAD_RETRIES} attempts: {str(e)}")
+                st.error("File upload failed. Please try again with smaller files or fewer files.")
                 return None
-            st.warning(f"Request failed, retrying ({attempt+1}/{max_retries})...")
-            time.sleep(2)  # Wait before retrying
-
-# Custom CSS for UI enhancements using given HEX colors
-st.markdown(
-    """
-    <style>
-    h1 {
-        color: #e14ed2;
-        text-align: center;
-    }
-    h2 {
-        color: #3edbda;
-    }
-    h3 {
-        color: #3edbda;
-    }
-    .stButton>button {
-        background-color: #e14ed2;
-        color: white;
-        border: none;
-    }
-    .stButton>button:hover {
-        background-color: #3edbda;
-    }
-    .error-message {
-        color: red;
-        background-color: #ffeeee;
-        padding: 10px;
-        border-radius: 5px;
-        margin: 10px 0;
-    }
-    </style>
-    """,
-    unsafe_allow_html=True,
-)
+            st.warning(f"Uploading {file.name} failed, retrying ({attempt+1}/{UPLOAD_RETRIES})...")
+            # Full jitter so parallel uploads don't all retry at the same moment
+            time.sleep(random.uniform(0, UPLOAD_BACKOFF * 2 ** attempt))
+        except requests.exceptions.RequestException as e:
+            st.error(f"Uploading {file.name} failed: {str(e)}")
+            return None
 
-# Function to upload PDFs
+# Function to upload PDFs, one request per file sent in parallel
 def upload_pdfs(files):
     upload_url = f"{BASE_API_URL}/upload_pdfs/"
-    file_data = [("files", (file.name, file, "application/pdf")) for file in files]
-    return request_with_retry(requests.post, upload_url, files=file_data)
+    ctx = get_script_run_ctx()
+
+    def upload_file(file):
+        # Worker threads need the script context to show retry warnings and errors
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return upload_pdf(upload_url, file)
+
+    uploaded = []
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_UPLOADS) as executor:
+        for response in executor.map(upload_file, files):
+            if response and "Uploaded PDFs" in response:
+                uploaded.extend(response["Uploaded PDFs"])
+    return {"Uploaded PDFs": uploaded} if uploaded else None
+
+# Post a selection of uploaded PDFs and an LLM choice as form data
+def _post_pdf_selection(path, selected_pdfs, llm_choice):
+    return _post(path, data={"llm_choice": llm_choice, "pdf_files": selected_pdfs})
+
+# Comparing the same two PDFs with the same LLM reuses the earlier comparison for this long (in seconds)
+# instead of re-running summarization and the LLM. Failed requests raise, so they are never cached.
+RESPONSE_CACHE_TTL = 600
+RESPONSE_CACHE_MAX_ENTRIES = 128
 
 # Function to process PDFs
-def process_pdfs(selected_pdfs, llm_choice):
-    process_url = f"{BASE_API_URL}/process_pdfs/"
-    data = {"llm_choice": llm_choice, "pdf_files": selected_pdfs}
-    return request_with_retry(requests.post, process_url, data=data)
+process_pdfs = show_request_errors(functools.partial(_post_pdf_selection, "/process_pdfs/"))
+
+@st.cache_data(ttl=RESPONSE_CACHE_TTL, max_entries=RESPONSE_CACHE_MAX_ENTRIES, show_spinner=False)
+def cached_comparison(selected_pdfs, llm_choice):
+    return _post_pdf_selection("/compare_reports/", list(selected_pdfs), llm_choice)
 
-# Function to ask a question
+# Function to ask a question. Never cached: the backend keeps the conversation's memory, so the same
+# question can mean something different later on, and every turn has to reach that memory.
+@show_request_errors
 def ask_question(question, llm_choice):
-    ask_url = f"{BASE_API_URL}/ask_question/"
-    json_data = {"question": question, "llm_choice": llm_choice}
-    return request_with_retry(requests.post, ask_url, json=json_data)
+    return _post("/ask_question/", json={"question": question, "llm_choice": llm_choice})
 
-# Function to compare reports
+# Function to compare reports. The same two PDFs make the same comparison in either selection order.
+@show_request_errors
 def compare_reports(selected_pdfs, llm_choice):
-    compare_url = f"{BASE_API_URL}/compare_reports/"
-    data = {"llm_choice": llm_choice, "pdf_files": selected_pdfs}
-    return request_with_retry(requests.post, compare_url, data=data)
+    return cached_comparison(tuple(sorted(selected_pdfs)), llm_choice)
+
+# Render one answer source as a single raw HTML block. File names and snippets come from uploaded PDFs,
+# so every value is HTML-escaped, and newlines become <br> so a blank line can't end the block and
+# have the rest parsed as markdown.
+def source_html(idx, src):
+    file_name = html.escape(str(src["file"]))
+    page = html.escape(str(src["page"]))
+    snippet = html.escape(str(src["snippet"])).replace("\n", "<br>")
+    return (
+        f"<div><b>Source {idx}</b> - File: <code>{file_name}</code>, Page: <code>{page}</code></div>"
+        f"<details><summary>Snippet</summary>{snippet}</details>"
+    )
 
 # Add session state to keep track of uploaded files
 if 'uploaded_file_names' not in st.session_state:
     st.session_state.uploaded_file_names = []
 
-# Check if the backend is available
-backend_available = check_backend_health()
+# Check if the backend is available, re-checking right away when the user asks to
+if st.button("Check connection"):
+    check_backend_health.clear()
+backend_available, backend_error = check_backend_health(BASE_API_URL)
+if backend_error:
+    st.error(f"Backend connection error: {backend_error}")
 if not backend_available:
     st.warning(f"⚠️ Unable to connect to the backend at {BASE_API_URL}. Some features may not work.")
     st.info("If you're experiencing connection issues, please ensure the backend service is running and properly configured.")
@@ -105,13 +241,13 @@ else:
     st.success(f"✅ Connected to backend at {BASE_API_URL}")
 
 # Streamlit UI
-st.markdown("<h1>RAG-Power Survey Analysis</h1>", unsafe_allow_html=True)
+st.title("RAG-Power Survey Analysis")
 
 # Add information about the deployed app
 st.markdown("This application uses Retrieval-Augmented Generation (RAG) to analyze and compare market research reports.")
 
 # PDF Upload section
-st.markdown("<h2>Upload PDFs</h2>", unsafe_allow_html=True)
+st.header("Upload PDFs")
 uploaded_files = st.file_uploader("Upload PDF files", type=["pdf"], accept_multiple_files=True)
 
 if uploaded_files:
@@ -119,12 +255,15 @@ if uploaded_files:
         with st.spinner("Uploading PDFs..."):
             upload_response = upload_pdfs(uploaded_files)
             if upload_response and "Uploaded PDFs" in upload_response:
-                # Update our session state with the new file names
-                st.session_state.uploaded_file_names = [f.name for f in uploaded_files]
+                # Update our session state with the names the backend stored, computed once per upload
+                # rather than on every rerun, and leaving out any file whose upload failed
+                st.session_state.uploaded_file_names = upload_response["Uploaded PDFs"]
+                # Re-uploaded files may have new contents, so earlier comparisons no longer apply
+                cached_comparison.clear()
                 st.success(f"Uploaded PDFs successfully!")
 
 # LLM Selection and Process PDFs section
-st.markdown("<h2>Process PDFs</h2>", unsafe_allow_html=True)
+st.header("Process PDFs")
 saved_pdfs = st.multiselect("Select previously uploaded PDFs", st.session_state.uploaded_file_names)
 llm_choice = st.selectbox("Select LLM", ["Mixtral", "Phi", "Llama 3.1"])
 
@@ -140,7 +279,7 @@ if st.button("Process PDFs"):
         st.error("Please select PDFs and an LLM to process")
 
 # Ask Question section
-st.markdown("<h2>Ask a Question</h2>", unsafe_allow_html=True)
+st.header("Ask a Question")
 question = st.text_input("Type your question here")
 
 if st.button("Ask Question"):
@@ -151,31 +290,31 @@ if st.button("Ask Question"):
                 if "error" in question_response:
                     st.error(question_response["error"])
                 else:
-                    st.markdown("<h3>Answer:</h3>", unsafe_allow_html=True)
+                    st.subheader("Answer:")
                     st.write(question_response.get("answer"))
                     
-                    st.markdown("<h3>Sources:</h3>", unsafe_allow_html=True)
+                    st.subheader("Sources:")
                     sources = question_response.get("sources", [])
                     if sources:
-                        for idx, src in enumerate(sources, start=1):
-                            st.write(f"**Source {idx}** - File: `{src['file']}`, Page: `{src['page']}`")
-                            with st.expander("Snippet"):
-                                st.write(src["snippet"])
+                        # One markdown element for all sources, with each snippet in a collapsible block
+                        st.markdown(
+                            "\n\n".join(source_html(idx, src) for idx, src in enumerate(sources, start=1)),
+                            unsafe_allow_html=True,
+                        )
                     else:
                         st.write("No sources returned.")
                     
-                    st.markdown("<h3>Chat History:</h3>", unsafe_allow_html=True)
+                    st.subheader("Chat History:")
                     chat_history = question_response.get("chat_history", [])
                     if chat_history:
-                        for msg in chat_history:
-                            st.write(msg.get("content", ""))
+                        st.markdown("\n\n".join(msg.get("content", "") for msg in chat_history))
                     else:
                         st.write("No chat history available.")
     else:
         st.error("Please enter a question and select an LLM to ask")
 
 # New section: Compare Reports
-st.markdown("<h2>Compare Reports</h2>", unsafe_allow_html=True)
+st.header("Compare Reports")
 compare_pdfs = st.multiselect("Select exactly 2 PDFs to compare", st.session_state.uploaded_file_names, key="compare_select")
 llm_choice_compare = st.selectbox("Select LLM for Comparison", ["Mixtral", "Phi", "Llama 3.1"], key="compare")
 
@@ -187,12 +326,11 @@ if st.button("Compare Reports"):
                 if "error" in compare_response:
                     st.error(compare_response["error"])
                 else:
-                    st.markdown("<h3>Comparison:</h3>", unsafe_allow_html=True)
+                    st.subheader("Comparison:")
                     st.write(compare_response.get("comparison"))
-                    st.markdown("<h3>Individual Summaries:</h3>", unsafe_allow_html=True)
+                    st.subheader("Individual Summaries:")
                     summaries = compare_response.get("summaries", {})
-                    for file, summary in summaries.items():
-                        st.write(f"**{file}**:")
-                        st.write(summary)
+                    if summaries:
+                        st.markdown("\n\n".join(f"**{file}**:\n\n{summary}" for file, summary in summaries.items()))
     else:
         st.error("Please select exactly 2 PDFs and an LLM to compare")